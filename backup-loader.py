@@ -4,34 +4,156 @@
 
 import os
 import sys
-import json
+import gzip
+import time
 import argparse
+import importlib.util
 from datetime import datetime
+from collections import deque
+from functools import partial
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 
-from influxdb_client import InfluxDBClient, WriteOptions
+from influxdb_client import InfluxDBClient, WriteOptions, WritePrecision
 from influxdb_client.client.write_api import WriteType
 
 from loguru import logger
 
 from dynaconf import Dynaconf
 
-from sems_utils import parse_data, create_point
+from sems_utils import parse_data, append_record, lp_measurement, loads_json
 
 config = Dynaconf(
     envvar_prefix="CONFIG",
     settings_files=["config.toml"],
 )
 
+READ_CHUNK_SIZE = 1 << 20   # 1 MiB
+SHARD_SIZE = 16 << 20       # 16 MiB, unit of work for --jobs
+
+
+def iter_lines(f, chunk_size=READ_CHUNK_SIZE):
+    """Split a binary stream into lines, bypassing the text-mode decoder."""
+    tail = b""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+def is_compressed(path):
+    return path.endswith((".gz", ".zst"))
+
+
+def open_backup(path):
+    """Open a backup file for binary reading, decompressing .gz and .zst files."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        import zstandard    # Optional, only needed for .zst files
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, "rb", buffering=READ_CHUNK_SIZE)
+
+
+def iter_records(json_lines):
+    """Yield the decoded SEMS data of every JSONL record."""
+    for json_data in json_lines:
+        if not json_data.strip():
+            continue
+        sems_data = loads_json(json_data)
+        if not sems_data:
+            continue
+        yield sems_data
+
+
+class LineBatcher:
+    """Builds line protocol batches of up to 'batch_size' records in a bytearray."""
+
+    def __init__(self, measurement, batch_size):
+        self.measurement = measurement.encode()
+        self.batch_size = batch_size
+        self._buf = bytearray()
+        self._n_lines = 0
+
+    def add(self, sems_data):
+        """Add a record, returns the batch once it's full, otherwise None."""
+        if append_record(self._buf, self.measurement, sems_data):
+            self._n_lines += 1
+            if self._n_lines >= self.batch_size:
+                return self.flush()
+        return None
+
+    def flush(self):
+        """Return whatever is batched so far (b"" if nothing) and start over."""
+        batch = bytes(self._buf)
+        self._buf.clear()
+        self._n_lines = 0
+        return batch
+
+
+def split_file(path, n_shards):
+    """Split a file into (start, end) byte ranges aligned to line boundaries."""
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, "rb") as f:
+        for i in range(1, n_shards):
+            f.seek(size * i // n_shards)
+            f.readline()    # Move to the start of the next line
+            offset = f.tell()
+            if offsets[-1] < offset < size:
+                offsets.append(offset)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def load_shard(path, start, end, measurement, batch_size, dry_run):
+    """Parse one byte range of a backup file, runs in a worker process."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    n_records = 0
+    batches = []
+    failed = False
+    batcher = LineBatcher(measurement, batch_size)
+    try:
+        for sems_data in iter_records(data.split(b"\n")):
+            if dry_run:
+                parse_data(sems_data)   # Still check that it parses
+                n_records += 1
+                continue
+            batch = batcher.add(sems_data)
+            n_records += 1
+            if batch:
+                batches.append(batch)
+
+    except Exception as ex:
+        # Keep the records parsed so far, same as load_data()
+        logger.exception(ex)
+        failed = True
+
+    batches.append(batcher.flush())
+
+    return n_records, batches, failed
+
 
 class BackupLoader:
     def __init__(self, config):
         self.config = config
+        self._lp_measurement = lp_measurement(self.config.influxdb.measurement)
 
         if not self.config.dry_run:
             influx_client = InfluxDBClient(
                 url=self.config.influxdb.url,
                 organization=self.config.influxdb.organization,
                 token=self.config.influxdb.token,
+                # Bulk writes compress well, unlike the live poller's single points
+                enable_gzip=True,
             )
             influx_ready = influx_client.ready()
             if influx_ready.status != "ready":
@@ -40,27 +162,81 @@ class BackupLoader:
             logger.success(f"Connected to InfluxDB at {self.config.influxdb.url} (server uptime: {influx_ready.up})")
 
             self.influx_writer = influx_client.write_api(
-                write_options=WriteOptions(write_type=WriteType.batching, batch_size=50_000, flush_interval=10_000)
+                # Each write() is a whole batch already, see LineBatcher
+                write_options=WriteOptions(
+                    write_type=WriteType.batching,
+                    batch_size=1,
+                    flush_interval=10_000,
+                    jitter_interval=0,
+                )
+            )
+
+    def write_batch(self, batch):
+        if batch:
+            logger.debug("Writing batch of {} bytes", len(batch))
+            self.influx_writer.write(
+                self.config.influxdb.bucket, self.config.influxdb.organization,
+                record=batch, write_precision=WritePrecision.S,
             )
 
     def load_data(self, f):
         n_records = 0
+        batcher = LineBatcher(self._lp_measurement, self.config.batch_size)
+        dry_run = self.config.dry_run
+        add_record = batcher.add
+        write_batch = self.write_batch
         try:
-            for json_data in f:
-                sems_data = json.loads(json_data)
-                if not sems_data:
+            for sems_data in iter_records(iter_lines(f)):
+                if dry_run:
+                    parse_data(sems_data)   # Still check that it parses
+                    n_records += 1
                     continue
-                timestamp, out_data = parse_data(sems_data)
-                # logger.info(f"{timestamp} {out_data}")
 
+                # Write to InfluxDBv2, one call per batch
+                batch = add_record(sems_data)
                 n_records += 1
+                if batch:
+                    write_batch(batch)
 
-                if self.config.dry_run:
-                    continue
+        except Exception as ex:
+            logger.exception(ex)
+
+        if not self.config.dry_run:
+            self.write_batch(batcher.flush())
+
+        return n_records
+
+    def load_file_parallel(self, path, jobs):
+        """Parse the file in 'jobs' worker processes, write from this one."""
+        n_shards = max(jobs, -(-os.path.getsize(path) // SHARD_SIZE))
+        shards = split_file(path, n_shards)
+        logger.debug("Loading {} in {} shards with {} workers", path, len(shards), jobs)
+
+        load = partial(
+            load_shard, path,
+            measurement=self._lp_measurement, batch_size=self.config.batch_size, dry_run=self.config.dry_run,
+        )
+
+        n_records = 0
+        try:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                # Results are held in memory until written, keep only a few shards in flight
+                shards = iter(shards)
+                pending = deque(executor.submit(load, start, end) for start, end in islice(shards, jobs * 2))
+                while pending:
+                    shard_records, batches, failed = pending.popleft().result()
+                    n_records += shard_records
+                    for batch in batches:
+                        self.write_batch(batch)
+
+                    if failed:
+                        # Stop at the first bad record, like load_data()
+                        for future in pending:
+                            future.cancel()
+                        break
 
-                # Write to InfluxDBv2
-                point = create_point(self.config.influxdb.measurement, timestamp, out_data)
-                self.influx_writer.write(self.config.influxdb.bucket, self.config.influxdb.organization, point)
+                    for start, end in islice(shards, 1):
+                        pending.append(executor.submit(load, start, end))
 
         except Exception as ex:
             logger.exception(ex)
@@ -75,8 +251,10 @@ class BackupLoader:
 def parse_arguments(config):
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", action="store_true", help="Print debug messages")
-    parser.add_argument("--file", metavar="FILE", help="Input JSON/JSONL file to load. Read from STDIN if not specified.")
+    parser.add_argument("--file", metavar="FILE", help="Input JSON/JSONL file to load, optionally .gz or .zst compressed (.zst needs the 'zstandard' package). Read from STDIN if not specified.")
     parser.add_argument("--dry-run", action="store_true", default=False, help="Don't write to InfluxDB")
+    parser.add_argument("--batch-size", metavar="N", type=int, default=5_000, help="Write to InfluxDB in batches of N records. Default is 5000.")
+    parser.add_argument("--jobs", metavar="N", type=int, default=1, help="Parse the input file in N worker processes. Default is 1. Ignored when reading from STDIN.")
 
     group_influxdb = parser.add_argument_group("InfluxDB options")
     group_influxdb.add_argument("--influxdb-url", metavar="URL", default=config.influxdb.url or "http://localhost:8086", help="InfluxDB connection URL. Default is 'http://localhost:8086'. Also $CONFIG_INFLUXDB__HOST")
@@ -87,6 +265,13 @@ def parse_arguments(config):
 
     args = parser.parse_args()
 
+    if args.batch_size < 1:
+        parser.error(f"Invalid --batch-size parameter: {args.batch_size}: Must be a positive number")
+    if args.jobs < 1:
+        parser.error(f"Invalid --jobs parameter: {args.jobs}: Must be a positive number")
+    if args.file and args.file.endswith(".zst") and not importlib.util.find_spec("zstandard"):
+        parser.error(f"Can't read {args.file}: .zst files need the 'zstandard' package (pip install zstandard)")
+
     config.influxdb.url = args.influxdb_url
     config.influxdb.organization = args.influxdb_organization
     config.influxdb.bucket = args.influxdb_bucket
@@ -94,6 +279,7 @@ def parse_arguments(config):
     config.influxdb.measurement = args.influxdb_measurement
 
     config.dry_run = args.dry_run
+    config.batch_size = args.batch_size
 
     # Update logging level (loguru default is DEBUG, ie. don't do anything if --debug)
     if not args.debug:
@@ -113,12 +299,17 @@ if __name__ == "__main__":
     args = parse_arguments(config) # Update 'config' inline
     backup_loader = BackupLoader(config)
 
-    data_file = sys.stdin
-    if args.file and args.file != "-":
-        data_file = open(args.file, "rt")
-
-    n_records = backup_loader.load_data(data_file)
+    start_time = time.monotonic()
+    if not args.file or args.file == "-":
+        n_records = backup_loader.load_data(sys.stdin.buffer)
+    elif args.jobs > 1 and not is_compressed(args.file):
+        n_records = backup_loader.load_file_parallel(args.file, args.jobs)
+    else:
+        if args.jobs > 1:
+            logger.warning("Compressed files can't be split, ignoring --jobs")
+        with open_backup(args.file) as data_file:
+            n_records = backup_loader.load_data(data_file)
 
     backup_loader.close()
 
-    logger.success(f"Loaded {n_records} records")
\ No newline at end of file
+    logger.success(f"Loaded {n_records} records in {time.monotonic() - start_time:.1f} seconds")
\ No newline at end of file
@@ -6,25 +6,28 @@
 
 import os
 import sys
-import json
 import time
+import queue
+import atexit
 import argparse
+import threading
 from datetime import datetime
+from functools import partial
 
 import requests
-import jmespath
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from influxdb_client import InfluxDBClient
+from influxdb_client import InfluxDBClient, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
 from influxdb_client.rest import ApiException as InfluxDBApiException
 
 from rocketry import Rocketry
 from loguru import logger
-from dotwiz import DotWiz
 
 from dynaconf import Dynaconf
 
-from sems_utils import parse_data, create_point
+from sems_utils import parse_data, format_lp, lp_measurement, loads_json, dumps_json
 
 config = Dynaconf(
     envvar_prefix="CONFIG",
@@ -50,6 +53,26 @@ class SemsApi:
         self._password = password
         self._plant_id = plant_id
         self._token = None
+        self._token_header = None
+
+        # The request bodies never change, encode them up front
+        self._login_data = dumps_json({"account": username, "pwd": password})
+        self._plant_data = dumps_json({"powerStationId": plant_id})
+
+        # Reuse the connection to SEMS between polls (keep-alive)
+        self._session = requests.Session()
+        self._session.headers.update(self._DefaultHeaders)
+        # Both SEMS calls are POSTs, but safe to retry on 5xx responses. Never retry
+        # after a read error, a timeout is raised as requests' Timeout right away
+        retry = Retry(
+            total=3,
+            read=False,
+            status=3,
+            backoff_factor=0.5,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=["POST"],
+        )
+        self._session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=retry))
 
     def _is_success_response(self, json_response):
         """Check if the API response indicates success.
@@ -71,6 +94,8 @@ class SemsApi:
     def login(self):
         logger.debug("Login to SEMS portal")
         self._token = self.getLoginToken()
+        # The token only changes on login, serialize it once for all data requests
+        self._token_header = dumps_json(self._token).decode() if self._token else None
         logger.success(f"Logged into GoodWe SEMS Portal {self._token['api']} as {self._username}")
 
     def getLoginToken(self):
@@ -79,25 +104,20 @@ class SemsApi:
             # Get our Authentication Token from SEMS Portal API
             logger.debug("SEMS - Getting API token")
 
-            # Prepare Login Data to retrieve Authentication Token
-            # Dict won't work here somehow, so this magic string creation must do.
-            login_data = '{"account":"' + self._username + '","pwd":"' + self._password + '"}'
-            # login_data = {"account": userName, "pwd": password}
-
             # Make POST request to retrieve Authentication Token from SEMS API
-            login_response = requests.post(
+            login_response = self._session.post(
                 self._LoginURL,
-                headers=self._DefaultHeaders,
-                data=login_data,
+                data=self._login_data,
                 timeout=self._RequestTimeout,
             )
-            logger.debug(f"Login Response: {login_response.text}")
+            # Lazy, response.text has to guess the charset and the dumps can be big
+            logger.opt(lazy=True).debug("Login Response: {}", lambda: login_response.text)
 
             login_response.raise_for_status()
 
             # Process response as JSON
-            jsonResponse = login_response.json()
-            logger.debug(f"Login JSON Response: {jsonResponse}")
+            jsonResponse = loads_json(login_response.content)
+            logger.debug("Login JSON Response: {}", jsonResponse)
 
             # Check if login was successful - handle different response formats and languages
             if not self._is_success_response(jsonResponse):
@@ -109,7 +129,7 @@ class SemsApi:
             tokenDict = jsonResponse["data"]
             tokenDict["api"] = jsonResponse["api"]
 
-            logger.debug(f"SEMS - API Token received: {tokenDict}")
+            logger.debug("SEMS - API Token received: {}", tokenDict)
             return tokenDict
 
         except requests.exceptions.Timeout as ex:
@@ -128,63 +148,54 @@ class SemsApi:
     def getData(self, powerStationId=None, renewToken=False, maxTokenRetries=2):
         """Get the latest data from the SEMS API and updates the state."""
         try:
-            # Get the status of our SEMS Power Station
-            logger.debug("SEMS - Making Power Station Status API Call")
-            if maxTokenRetries <= 0:
-                logger.warning(
-                    "SEMS - Maximum token fetch tries reached, aborting for now"
-                )
-                raise OutOfRetries
-            if self._token is None or renewToken:
-                logger.debug("API token not set or new token requested, fetching")
-                self.login()
-                # Check if login was successful
-                if self._token is None:
-                    logger.error("Login failed, unable to get valid token")
-                    raise OutOfRetries
-
-            # Prepare Power Station status Headers
-            headers = {
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "token": json.dumps(self._token),
-            }
-
-            powerStationURL = self._token["api"] + self._PowerStationURLPart
             if powerStationId is None:
                 powerStationId = self._plant_id
-            logger.debug(
-                f"Querying SEMS API {powerStationURL} for power station id {powerStationId}"
-            )
+                data = self._plant_data
+            else:
+                data = dumps_json({"powerStationId": powerStationId})
+            if renewToken:
+                self._token = None
 
-            data = '{"powerStationId":"' + powerStationId + '"}'
+            for attempt in range(maxTokenRetries):
+                # Get the status of our SEMS Power Station
+                logger.debug("SEMS - Making Power Station Status API Call")
+                if self._token is None:
+                    logger.debug("API token not set or new token requested, fetching")
+                    self.login()
+                    # Check if login was successful
+                    if self._token is None:
+                        logger.error("Login failed, unable to get valid token")
+                        raise OutOfRetries
+
+                # Only the token differs from the session's default headers
+                headers = {"token": self._token_header}
+
+                powerStationURL = self._token["api"] + self._PowerStationURLPart
+                logger.debug("Querying SEMS API {} for power station id {}", powerStationURL, powerStationId)
+
+                response = self._session.post(
+                    powerStationURL,
+                    headers=headers,
+                    data=data,
+                    timeout=self._RequestTimeout,
+                )
+                logger.debug("Power station API response status: {}", response.status_code)
+                logger.opt(lazy=True).debug("Power station API response headers: {}", lambda: dict(response.headers))
+                logger.opt(lazy=True).debug("Power station API response body: {}", lambda: response.text)
 
-            response = requests.post(
-                powerStationURL,
-                headers=headers,
-                data=data,
-                timeout=self._RequestTimeout,
-            )
-            logger.debug(f"Power station API response status: {response.status_code}")
-            logger.debug(f"Power station API response headers: {dict(response.headers)}")
-            logger.debug(f"Power station API response body: {response.text}")
+                jsonResponse = loads_json(response.content)
 
-            jsonResponse = response.json()
+                if self._is_success_response(jsonResponse):
+                    return jsonResponse["data"]
 
-            # try again and renew token if unsuccessful - handle different response formats and languages
-            if not self._is_success_response(jsonResponse):
-                logger.debug(f"Query not successful: {jsonResponse['msg']}")
-                if maxTokenRetries <= 1:
-                    logger.warning("SEMS - Maximum token fetch tries reached, aborting")
-                    raise OutOfRetries
-                logger.debug(
-                    f"Retrying with new token, {maxTokenRetries - 1} retries remaining"
-                )
-                return self.getData(
-                    powerStationId, renewToken=True, maxTokenRetries=maxTokenRetries - 1
-                )
+                # try again and renew token if unsuccessful - handle different response formats and languages
+                logger.debug("Query not successful: {}", jsonResponse["msg"])
+                self._token = None
+                if attempt + 1 < maxTokenRetries:
+                    logger.debug("Retrying with new token, {} retries remaining", maxTokenRetries - attempt - 1)
 
-            return jsonResponse["data"]
+            logger.warning("SEMS - Maximum token fetch tries reached, aborting")
+            raise OutOfRetries
 
         except OutOfRetries:
             # Re-raise OutOfRetries to be handled by the caller
@@ -228,9 +239,29 @@ class SemsProcessor:
         logger.success(f"Connected to InfluxDB at {self.config.influxdb.url} (server uptime: {influx_ready.up})")
 
         self.influx_writer = influx_client.write_api(write_options=SYNCHRONOUS)
+        # Read once, Dynaconf attribute access isn't cheap
+        self._lp_measurement = lp_measurement(self.config.influxdb.measurement)
+        self._bucket = self.config.influxdb.bucket
+        self._org = self.config.influxdb.organization
+        self._skip_unchanged = self.config.skip_unchanged
+
+        # Last values written to InfluxDB, for --skip-unchanged
+        self._last_out_data = None
+
+        # Today's JSONL file is kept open between ticks, see save_json()
+        self._json_fh = None
+        self._json_day = None
+
+        # Saving and InfluxDB writes run in a background thread so that
+        # a slow disk or InfluxDB doesn't delay the next poll
+        self._out_q = queue.Queue(maxsize=64)
+        threading.Thread(target=self._consume, name="sems-output", daemon=True).start()
+        atexit.register(self.close)
 
     def run(self):
-        app = Rocketry(execution="thread")
+        # A single task whose output I/O is already on the background
+        # thread, so run it in the scheduler's thread instead of a new one per tick
+        app = Rocketry(execution="main")
         app.task(
             f"every {self.config.sems.period} seconds",
             func=self.data_task,
@@ -240,10 +271,54 @@ class SemsProcessor:
     def save_json(self, sems_data):
         if config.save_json_dir:
             today = datetime.now().strftime("%Y-%m-%d")
-            filename = f"{config.save_json_dir}/{today}.jsonl"
-            with open(filename, "at+") as f:
-                print(json.dumps(sems_data), file=f)    # To ensure a newline at the end
-            logger.debug(f"Updated: {filename}")
+            if today != self._json_day:
+                self.close_json()
+                filename = f"{config.save_json_dir}/{today}.jsonl"
+                self._json_fh = open(filename, "ab")
+                self._json_day = today
+                logger.debug("Opened: {}", filename)
+            self._json_fh.write(dumps_json(sems_data) + b"\n")
+            # Hand the line to the OS straight away, there's only one per tick
+            self._json_fh.flush()
+
+    def close_json(self):
+        if self._json_fh is not None:
+            self._json_fh.close()
+            self._json_fh = None
+            self._json_day = None
+
+    def close(self):
+        # Let the background thread finish the pending output first
+        self._out_q.join()
+        self.close_json()
+
+    def write_influx(self, line, out_data=None):
+        self.influx_writer.write(self._bucket, self._org, record=line, write_precision=WritePrecision.S)
+        # Only once written, a failed or dropped write must not skip the next ones
+        self._last_out_data = out_data
+
+    def _submit(self, job):
+        try:
+            self._out_q.put_nowait(job)
+        except queue.Full:
+            logger.warning("Output queue is full, dropping data.")
+
+    def _consume(self):
+        while True:
+            job = self._out_q.get()
+            try:
+                job()
+            except InfluxDBApiException as ex:
+                if ex.status == 401:
+                    logger.error("InfluxDB authentication failed. Please check your InfluxDB token configuration.")
+                elif ex.status == 404:
+                    logger.error("InfluxDB bucket or organization not found. Please check your InfluxDB configuration.")
+                else:
+                    logger.error(f"InfluxDB error ({ex.status}): {ex.reason}.")
+            except Exception as ex:
+                logger.error(f"Unexpected error during data output: {ex}.")
+            finally:
+                self._out_q.task_done()
 
     def data_task(self):
         try:
@@ -252,13 +327,20 @@ class SemsProcessor:
                 logger.error("No data received from SEMS API.")
                 return
 
-            self.save_json(sems_data)
+            self._submit(partial(self.save_json, sems_data))
             timestamp, out_data = parse_data(sems_data)
-            logger.info(f"{timestamp} {out_data}")
+            # Positional args, so loguru only formats the message if INFO is enabled
+            logger.info("{} {}", timestamp, out_data)
+
+            # E.g. at night nothing changes for hours
+            if self._skip_unchanged and out_data == self._last_out_data:
+                logger.debug("Data unchanged, skipping InfluxDB write")
+                return
 
             # Write to InfluxDBv2
-            point = create_point(self.config.influxdb.measurement, timestamp, out_data)
-            self.influx_writer.write(self.config.influxdb.bucket, self.config.influxdb.organization, point)
+            line = format_lp(self._lp_measurement, timestamp, out_data)
+            if line:
+                self._submit(partial(self.write_influx, line, out_data))
 
         except OutOfRetries:
             logger.error("Failed to retrieve data from SEMS after maximum retry attempts.")
@@ -268,13 +350,6 @@ class SemsProcessor:
             logger.error("Failed to connect to SEMS API.")
         except requests.exceptions.RequestException as ex:
             logger.error(f"SEMS API request failed: {ex}.")
-        except InfluxDBApiException as ex:
-            if ex.status == 401:
-                logger.error("InfluxDB authentication failed. Please check your InfluxDB token configuration.")
-            elif ex.status == 404:
-                logger.error("InfluxDB bucket or organization not found. Please check your InfluxDB configuration.")
-            else:
-                logger.error(f"InfluxDB error ({ex.status}): {ex.reason}.")
         except Exception as ex:
             logger.error(f"Unexpected error during data processing: {ex}.")
 
@@ -283,6 +358,7 @@ def parse_arguments(config):
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", action="store_true", help="Print debug messages")
     parser.add_argument("--save-json-dir", metavar="DIR", help="Save the received JSON files to this directory")
+    parser.add_argument("--skip-unchanged", action="store_true", help="Don't write to InfluxDB if the values haven't changed since the last poll")
 
     group_sems = parser.add_argument_group("GoodWe SEMS Portal options")
     group_sems.add_argument("--sems-username", metavar="USERNAME", default=config.sems.username, help="SEMS Portal username (preferably a unique 'visitor' email). Also $CONFIG_SEMS__USERNAME")
@@ -312,6 +388,7 @@ def parse_arguments(config):
     config.influxdb.measurement = args.influxdb_measurement
 
     config.save_json_dir = args.save_json_dir
+    config.skip_unchanged = args.skip_unchanged
 
     # Update logging level (loguru default is DEBUG, ie. don't do anything if --debug)
     if not args.debug:
@@ -1,9 +1,27 @@
+import re
+import math
 from datetime import datetime
-import jmespath
-from dotwiz import DotWiz
+from functools import lru_cache
+from jmespath.parser import Parser as JMESPathParser
 from influxdb_client import Point, WritePrecision
 
-METRICS = DotWiz({
+try:
+    import orjson
+
+    loads_json = orjson.loads
+    dumps_json = orjson.dumps
+
+except ImportError:
+    import json
+
+    # Fallback to stdlib json, keeping the orjson bytes-in / bytes-out interface
+    def loads_json(data):
+        return json.loads(data)
+
+    def dumps_json(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+METRICS = {
     ## Power plant stats
     "d_pv_sum": "energeStatisticsCharts.sum",                   # Today total PV generation
     "d_pv_use": "energeStatisticsCharts.selfUseOfPv",           # Today PV consumption
@@ -34,53 +52,220 @@ METRICS = DotWiz({
     "iac": "inverter[0].d.iac1",      # AC current
     "fac": "inverter[0].d.fac1",      # AC frequency
     "pac": "inverter[0].d.pac",       # AC power
-})
+}
 
-def parse_data(sems_data):
-    out_data = {}
+# One parser for all the expressions instead of a new one per jmespath.compile()
+_JMESPATH_PARSER = JMESPathParser()
+# Same as JMESPath's unquoted identifiers, so ASCII only
+_SIMPLE_PATH = re.compile(r"[A-Za-z_]\w*(\[\d+\])*(\.[A-Za-z_]\w*(\[\d+\])*)*", re.ASCII)
+_PATH_STEP = re.compile(r"([A-Za-z_]\w*)|\[(\d+)\]", re.ASCII)
+
+def _compile_path(expr):
+    """Compile a METRICS expression into a search(sems_data) function.
+
+    Plain paths like "powerflow.pv" or "inverter[0].d.vpv1" are walked
+    directly, anything else (filters, pipes, ...) is left to JMESPath.
+    """
+    if not _SIMPLE_PATH.fullmatch(expr):
+        return _JMESPATH_PARSER.parse(expr).search
+
+    # Names are dict keys, [N] are list indexes
+    steps = tuple(
+        name if name else int(index)
+        for name, index in _PATH_STEP.findall(expr)
+    )
+
+    def search(data):
+        # Same result as JMESPath: None once the path doesn't match
+        for step in steps:
+            if type(step) is str:
+                if not isinstance(data, dict):
+                    return None
+                data = data.get(step)
+            else:
+                if not isinstance(data, list) or step >= len(data):
+                    return None
+                data = data[step]
+        return data
 
-    ## Parse the timestamp
-    info_time = jmespath.search("info.time", sems_data)
+    return search
+
+# Compile the expressions once, parse_data() runs for every record.
+# Powerflow values need post-processing, sort them out up front too.
+_PLAIN_METRICS = tuple(
+    (key, _compile_path(value))
+    for key, value in METRICS.items() if not value.startswith("powerflow")
+)
+_POWERFLOW_METRICS = tuple(
+    (key, _compile_path(value), value == "powerflow.grid")
+    for key, value in METRICS.items() if value.startswith("powerflow")
+)
+_FIELD_KEYS = tuple(METRICS)
+
+def _parse_watts(value):
+    """Parse a powerflow value like "3503(W)", the number is usually an integer."""
+    try:
+        return int(value[:-3])
+    except ValueError:
+        return int(float(value[:-3]))
+
+@lru_cache(maxsize=2)
+def parse_sems_time(info_time):
+    """Convert SEMS 'MM/DD/YYYY HH:MM:SS' local time to a Unix timestamp.
+
+    Fixed-format slicing, much faster than datetime.strptime(). Cached
+    because SEMS often returns the same sample on consecutive polls.
+    """
+    return int(datetime(
+        int(info_time[6:10]), int(info_time[0:2]), int(info_time[3:5]),
+        int(info_time[11:13]), int(info_time[14:16]), int(info_time[17:19]),
+    ).timestamp())
+
+def _parse_timestamp(sems_data):
+    try:
+        info_time = sems_data["info"]["time"]
+    except (KeyError, TypeError):
+        info_time = None
+    if not info_time:
+        raise ValueError("SEMS record has no info.time")
     # The time in 'info.time' is apparently in our local timezone
-    timestamp = datetime.strptime(info_time, "%m/%d/%Y %H:%M:%S").timestamp()
-
-    ## Parse all required values
-    for key in METRICS:
-        value = METRICS[key]
-        out_data[key] = jmespath.search(value, sems_data)
-
-        # Powerflow is reported as a string, e.g. "3503(W)"
-        if value.startswith("powerflow"):
-            if not out_data[key]:
-                # Sometimes the API returns None or empty string for powerflow values
-                del out_data[key]
-                continue
+    return info_time, parse_sems_time(info_time)
+
+def _iter_fields(sems_data, info_time):
+    """Yield (key, value) for every metric that has a usable value."""
+    for key, search in _PLAIN_METRICS:
+        value = search(sems_data)
+        if value is not None:
+            yield key, value
+
+    # Powerflow is reported as a string, e.g. "3503(W)"
+    for key, search, is_grid in _POWERFLOW_METRICS:
+        value = search(sems_data)
+
+        if not value:
+            # Sometimes the API returns None or empty string for powerflow values
+            continue
 
-            if out_data[key].endswith("(W)"):
-                out_data[key] = int(float(out_data[key][:-3]))
+        if value.endswith("(W)"):
+            value = _parse_watts(value)
 
-                # Filter out noise
-                if abs(out_data[key]) < 10:
-                    out_data[key] = 0
-                    continue
+            # Filter out noise
+            if abs(value) < 10:
+                value = 0
 
-                # The grid flow direction seems to be indicated by loadStatus field,
-                # who knows what gridStatus is for then...
-                # I don't have a PV battery, not sure how the powerflows are reported for it.
-                # This is brain-dead (as is most of this API).
-                if value == "powerflow.grid":
-                    flow_direction = jmespath.search("powerflow.loadStatus", sems_data)
-                    out_data[key] *= flow_direction
+            # The grid flow direction seems to be indicated by loadStatus field,
+            # who knows what gridStatus is for then...
+            # I don't have a PV battery, not sure how the powerflows are reported for it.
+            # This is brain-dead (as is most of this API).
+            elif is_grid:
+                flow_direction = sems_data["powerflow"].get("loadStatus")
+                value *= flow_direction
 
-            if type(out_data[key]) != int:
-                print(f"Type error: {info_time}: {key}: '{out_data[key]}'")
-                del out_data[key]
+        if type(value) != int:
+            print(f"Type error: {info_time}: {key}: '{value}'")
+            continue
 
-    return int(timestamp), out_data
+        yield key, value
+
+def parse_data(sems_data):
+    info_time, timestamp = _parse_timestamp(sems_data)
+
+    # All keys up front, values that can't be parsed stay None (skipped on write)
+    out_data = dict.fromkeys(_FIELD_KEYS)
+    out_data.update(_iter_fields(sems_data, info_time))
+
+    return timestamp, out_data
 
 def create_point(measurement, timestamp, out_data):
-    point = Point(measurement).time(timestamp, WritePrecision.S)
-    for key in out_data:
-        point.field(key, out_data[key])
+    return Point.from_dict(
+        {"measurement": measurement, "time": timestamp, "fields": out_data},
+        write_precision=WritePrecision.S,
+    )
+
+# Line protocol escaping, same rules as influxdb_client's Point
+_LP_ESCAPE_MEASUREMENT = str.maketrans({",": r"\,", " ": r"\ ", "\n": r"\n", "\t": r"\t", "\r": r"\r"})
+_LP_ESCAPE_KEY = str.maketrans({"\\": "\\\\", ",": r"\,", " ": r"\ ", "=": r"\=", "\n": r"\n", "\t": r"\t", "\r": r"\r"})
+_LP_ESCAPE_STRING = str.maketrans({'"': r'\"', "\\": "\\\\"})
+
+def _format_lp_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return None
+        s = str(value)
+        return s[:-2] if s.endswith(".0") else s
+    if isinstance(value, str):
+        return f'"{value.translate(_LP_ESCAPE_STRING)}"'
+    raise ValueError(f'Type: "{type(value)}" of field is not supported.')
+
+# The field keys are known up front, escape them only once
+_LP_FIELD_KEYS = {key: key.translate(_LP_ESCAPE_KEY) for key in METRICS}
+_LP_FIELD_KEYS_B = {key: f"{lp_key}=".encode() for key, lp_key in _LP_FIELD_KEYS.items()}
+
+def lp_measurement(measurement):
+    """Escape a measurement name for use with format_lp()."""
+    return measurement.translate(_LP_ESCAPE_MEASUREMENT)
+
+def format_lp(measurement, timestamp, out_data):
+    """Format a record as a line protocol string (timestamp in seconds).
+
+    Same escaping and value formatting as create_point(...).to_line_protocol()
+    without building the Point, except that the fields are kept in 'out_data'
+    order rather than sorted. The 'measurement' must already be escaped with
+    lp_measurement(). Returns an empty string if there are no fields.
+    """
+    fields = []
+    for key, value in out_data.items():
+        if value is None:
+            continue
+        value = _format_lp_value(value)
+        if value is None:
+            continue
+        lp_key = _LP_FIELD_KEYS.get(key) or key.translate(_LP_ESCAPE_KEY)
+        fields.append(f"{lp_key}={value}")
+
+    if not fields:
+        return ""
+
+    return f"{measurement} {','.join(fields)} {timestamp}"
+
+def append_record(buf, measurement, sems_data):
+    """Parse a SEMS record straight into a bytearray of line protocol.
+
+    Same fields as parse_data() followed by format_lp(), in a single pass
+    and without the intermediate dict. Lines are separated by newlines,
+    the 'measurement' must be escaped with lp_measurement() and encoded.
+    Returns False and leaves 'buf' unchanged if there are no fields,
+    'buf' is also left unchanged if the record fails to parse.
+    """
+    info_time, timestamp = _parse_timestamp(sems_data)
+
+    start = len(buf)
+    if start:
+        buf += b"\n"
+    buf += measurement
+
+    sep = b" "
+    try:
+        for key, value in _iter_fields(sems_data, info_time):
+            value = _format_lp_value(value)
+            if value is None:
+                continue
+            buf += sep
+            buf += _LP_FIELD_KEYS_B[key]
+            buf += value.encode()
+            sep = b","
+    except Exception:
+        # Don't leave a partial line behind for the caller to flush
+        del buf[start:]
+        raise
+
+    if sep == b" ":
+        del buf[start:]
+        return False
 
-    return point
+    buf += b" %d" % timestamp
+    return True